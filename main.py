@@ -1,7 +1,11 @@
+import logging
 import src.config
 from src.server import start_server_thread
-from src.ui import demo
+from src.agent import warm_up
+from src.ui import build_demo, LAUNCH_MAX_THREADS
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     start_server_thread()
-    demo.launch()
+    warm_up()
+    build_demo().launch(max_threads=LAUNCH_MAX_THREADS)
@@ -1,16 +1,28 @@
+import re
 import json
-import google.generativeai as genai
-from jsonschema import validate, ValidationError
-from src.schemas import AGENT_OUTPUT_SCHEMA
+import time
+import hashlib
+import functools
+import asyncio
+import logging
+import orjson
+from collections import OrderedDict, deque
+from collections.abc import Mapping
+from src.config import GOOGLE_API_KEY, CONSTRAINED_DECODING, GEMINI_MAX_CONCURRENCY, MUSIC_CACHE_TTL
+from src.schemas import AGENT_RESPONSE_SCHEMA, SchemaError, validate_agent_output
 from src.api_interface import TikTokAPI
 
-class AdAgent:
-    def __init__(self, api_client: TikTokAPI):
-        self.api_client = api_client
-        self.model = genai.GenerativeModel('gemini-1.5-pro-latest')
-        self.history = []
-        self.collected_data = {}
-        self.system_prompt = """
+logger = logging.getLogger(__name__)
+
+MAX_REASKS = 2
+HISTORY_WINDOW = 4  # turns replayed to the model; older turns live on as ad state + a short summary
+SUMMARY_EVERY = 4  # trimmed turns folded into the summary per Gemini call
+RESPONSE_CACHE_SIZE = 128
+RESPONSE_CACHE_TTL = 300  # seconds
+
+# Sent once per model as system_instruction, never per turn; keep it free of dynamic content.
+# Per-turn context (auth, system messages) goes into the trailing user message only.
+SYSTEM_PROMPT = """
 You are a TikTok Ads Agent.
 Rules:
 1. OAuth Check: If not authenticated, ask user to Connect.
@@ -19,57 +31,325 @@ Rules:
 4. Validation: Validate Music ID if provided.
 Output JSON: { "thought": "...", "message_to_user": "...", "action": "NONE|VALIDATE_MUSIC|SUBMIT_AD|UPLOAD_MUSIC", "action_params": {}, "updated_ad_state": {} }
 """
+@functools.cache
+def _genai():
+    # google.generativeai drags in grpc/protobuf; import it on first model use, not on module import
+    import google.generativeai as genai
+    genai.configure(api_key=GOOGLE_API_KEY)
+    return genai
+
+def warm_up():
+    # Pays the genai import/configure at startup, before the event loop serves any session
+    _generation_config()
+
+@functools.cache
+def _generation_config():
+    # JSON mode: Gemini emits a bare JSON object (no prose/fences to strip). Built once, not per request.
+    # With CONSTRAINED_DECODING the schema is enforced during sampling as well.
+    return _genai().GenerationConfig(
+        response_mime_type="application/json",
+        response_schema=AGENT_RESPONSE_SCHEMA if CONSTRAINED_DECODING else None,
+    )
+
+# --- Fast-Path Patterns (checked against the next missing slot) ---
+_OBJECTIVE_RE = re.compile(r"^\s*(Traffic|Conversions)\s*$", re.I)
+_MUSIC_ID_RE = re.compile(r"^\s*(\d{3,})\s*$")
+_NO_MUSIC_RE = re.compile(r"^\s*(no music|skip|none)\s*$", re.I)
+_UPLOAD_RE = re.compile(r"^\s*upload\b", re.I)
+
+_SLOT_PROMPTS = {
+    "objective": "Got it. What is the objective: Traffic or Conversions?",
+    "music": "Which music should the ad use? Send a Music ID, attach a file and say 'upload', or 'skip' (Traffic only).",
+    "ad_text": "What should the ad text say? (max 100 characters)",
+    "done": "All details collected. Say 'submit' to create the ad.",
+}
+
+_FAST_MESSAGES = {"VALIDATE_MUSIC": "Checking that music ID...", "UPLOAD_MUSIC": "Uploading your music..."}
+
+_FENCE_RE = re.compile(r"```(?:json)?\s*(\{.*\})\s*```", re.S)
+_PARTIAL_MSG_RE = re.compile(r'"message_to_user"\s*:\s*"((?:[^"\\]|\\.)*)(")?')
+
+def _extract_text(res):
+    # Robust Text Extraction
+    if hasattr(res, "text"):
+        return res.text
+    if hasattr(res, "output_text"):
+        return res.output_text
+    if hasattr(res, "candidates") and res.candidates:
+        cand = res.candidates[0]
+        return getattr(cand, "content", None) or getattr(cand, "output", None)
+    return None
+
+def _parse_reply(text):
+    # Clean markdown (fallback if JSON mode is ignored); JSON mode replies are bare, so skip the regex for them
+    if "```" in text:
+        m = _FENCE_RE.search(text)
+        if m: text = m.group(1)
+    return orjson.loads(text.strip())
+
+def _partial_message(text):
+    # (message_to_user decoded from an incomplete JSON buffer or None if not started / mid-escape, closed?)
+    m = _PARTIAL_MSG_RE.search(text)
+    if not m: return None, False
+    try:
+        return json.loads(f'"{m.group(1).rstrip(chr(92))}"'), bool(m.group(2))
+    except ValueError:
+        return None, False
+
+# Prompt digest -> (stored_at, validated raw reply), shared across sessions.
+# Only plain collect turns (action NONE) are stored so validation/submit results are never replayed.
+_RESPONSE_CACHE = OrderedDict()
+
+def _cached_response(key):
+    hit = _RESPONSE_CACHE.get(key)
+    if not hit: return None
+    if time.time() - hit[0] > RESPONSE_CACHE_TTL:
+        del _RESPONSE_CACHE[key]
+        return None
+    _RESPONSE_CACHE.move_to_end(key)
+    return hit[1]
+
+def _cache_response(key, text):
+    _RESPONSE_CACHE[key] = (time.time(), text)
+    _RESPONSE_CACHE.move_to_end(key)
+    if len(_RESPONSE_CACHE) > RESPONSE_CACHE_SIZE: _RESPONSE_CACHE.popitem(last=False)
+
+# All sessions' requests share the one async Gemini channel; this caps how many are in flight
+# so bursts queue locally instead of tripping provider rate limits.
+_LLM_SLOTS = asyncio.Semaphore(GEMINI_MAX_CONCURRENCY)
+
+async def _pump_stream(model, msgs, out):
+    # Reads the whole Gemini stream into `out` under a slot. The slot is freed when the stream ends,
+    # however slowly (or whether) the UI consumes the queue. Ends with None; errors are passed through.
+    try:
+        async with _LLM_SLOTS:
+            res = await model.generate_content_async(msgs, generation_config=_generation_config(), stream=True)
+            async for chunk in res: out.put_nowait(_extract_text(chunk) or "")
+    except Exception as e:
+        out.put_nowait(e)
+    finally:
+        out.put_nowait(None)
+
+@functools.cache
+def _model(name, system_instruction=None):
+    # Shared by every session's agent; built on first use
+    return _genai().GenerativeModel(name, system_instruction=system_instruction)
+
+class AdAgent:
+    def __init__(self, api_client: TikTokAPI, model_cheap='gemini-1.5-flash-latest', model_strong='gemini-1.5-pro-latest'):
+        self.api_client = api_client
+        # Slot-filling goes to the cheap model; submission and error recovery to the strong one
+        self.models = {"simple": _model(model_cheap, SYSTEM_PROMPT), "complex": _model(model_strong, SYSTEM_PROMPT)}
+        self._summary_model = _model(model_cheap)
+        self.history = deque(maxlen=HISTORY_WINDOW)
+        self.history_summary = ""
+        self._summary_task = None
+        self._trimmed = []  # turns out of the window but not yet summarized; still replayed
+        self.collected_data = {}
+        self._pending_music = None  # (music_id, asyncio.Task, started_at) of the latest music validation
+
+    def _remember(self, user_input, data):
+        # Turns leaving the window are summarized in batches: one extra Gemini call per SUMMARY_EVERY turns
+        if len(self.history) == self.history.maxlen:
+            self._trimmed.append(self.history[0])
+            # One summary at a time; the batch stays in _trimmed (and is replayed) until the summary lands
+            if len(self._trimmed) >= SUMMARY_EVERY and not (self._summary_task and not self._summary_task.done()):
+                self._summary_task = asyncio.create_task(self._summarize(list(self._trimmed)))
+        # The Gemini message pair is built (and the reply serialized) once here; prompts just replay it
+        self.history.append({"user": user_input, "agent": data, "msgs": (
+            {"role": "user", "parts": [user_input]},
+            {"role": "model", "parts": [orjson.dumps(data).decode()]},
+        )})
+
+    def record_event(self, text):
+        """Records an outcome the UI reported without an LLM turn, so later turns (and cache keys) see it."""
+        self._remember(f"System: {text}", {"thought": "System event.", "message_to_user": text,
+                                          "action": "NONE", "action_params": {}, "updated_ad_state": {}})
+
+    async def _summarize(self, turns):
+        exchange = "\n".join(f"User: {t['user']}\nAgent: {t['agent'].get('message_to_user', '')}" for t in turns)
+        prompt = (f"Summary so far: {self.history_summary or 'None'}\n"
+                  f"Fold in these exchanges; reply with one plain-text summary under 60 words.\n{exchange}")
+        try:
+            async with _LLM_SLOTS:
+                res = await self._summary_model.generate_content_async(prompt)
+            summary = (_extract_text(res) or "").strip()
+        except Exception as e:
+            logger.warning("History summary failed: %s", e)
+            return
+        # Turns only leave replay once the summary covers them; on failure they stay for the next batch.
+        # _trimmed is only appended to meanwhile, so the batch is still its prefix.
+        if summary:
+            self.history_summary = summary
+            del self._trimmed[:len(turns)]
+
+    def _next_slot(self):
+        # Workflow order: campaign_name -> objective -> music -> ad_text
+        creative = self.collected_data.get("creative_details") or {}
+        if not self.collected_data.get("campaign_name"): return "campaign_name"
+        if not self.collected_data.get("objective"): return "objective"
+        if not creative.get("music_id") and not self.collected_data.get("music_skipped"): return "music"
+        if not creative.get("ad_text"): return "ad_text"
+        return "done"
+
+    def _fresh_check(self, mid):
+        # Same TTL as the API clients' cache, so a taken-down track can't pass on an old result
+        p = self._pending_music
+        return p is not None and p[0] == mid and time.monotonic() - p[2] < MUSIC_CACHE_TTL
+
+    def _prefetch_music(self, mid):
+        # Validate in the background while the conversation moves on; awaited by validate_music()
+        if self._fresh_check(mid): return
+        task = asyncio.create_task(self.api_client.a_validate_music_id(mid))
+        self._pending_music = (mid, task, time.monotonic())
+
+    def clear_music_checks(self):
+        # Called after an upload, mirroring the API clients' cache invalidation
+        self._pending_music = None
+
+    async def validate_music(self, mid):
+        # Reuse the check already run for this ID (background or VALIDATE_MUSIC) so submit doesn't repeat it
+        self._prefetch_music(mid)
+        task = self._pending_music[1]
+        r = await task
+        # Failures are not remembered; the next check retries
+        if r["status"] == "error" and self._pending_music and self._pending_music[1] is task: self._pending_music = None
+        return r
+
+    def accept_music(self, mid):
+        """Commits a validated music ID. Returns the next slot prompt if the ID was new to the ad state, else None."""
+        creative = self.collected_data.setdefault("creative_details", {})
+        self.collected_data.pop("music_skipped", None)
+        if creative.get("music_id") == mid: return None
+        creative["music_id"] = mid
+        return _SLOT_PROMPTS[self._next_slot()]
+
+    def reject_music(self, mid):
+        # A failed ID must not stay in state, or _next_slot() would never ask for music again
+        creative = self.collected_data.get("creative_details") or {}
+        if creative.get("music_id") == mid: del creative["music_id"]
+
+    def _complexity(self, user_input, system_context):
+        if system_context or len(user_input) > 200: return "complex"
+        if self._next_slot() == "done": return "complex"  # confirmation / submit turn
+        return "simple"
+
+    def _fast_route(self, user_input):
+        """Fills the next missing slot from unambiguous input without calling the LLM. Returns None to fall back."""
+        if not self.api_client.access_token: return None
+        slot = self._next_slot()
+        state, action, params = {}, "NONE", {}
+
+        if slot == "objective" and (m := _OBJECTIVE_RE.match(user_input)):
+            state["objective"] = m.group(1).capitalize()
+        elif slot == "music" and (m := _MUSIC_ID_RE.match(user_input)):
+            # Not written to state yet: the UI commits it via accept_music() once validation passes
+            action, params = "VALIDATE_MUSIC", {"music_id": m.group(1)}
+        elif slot == "music" and self.collected_data.get("objective") == "Traffic" and _NO_MUSIC_RE.match(user_input):
+            # Tracked as a flag so no null music_id ends up in the submit payload
+            state["music_skipped"] = True
+        elif slot == "music" and _UPLOAD_RE.match(user_input):
+            action = "UPLOAD_MUSIC"  # the file itself comes from the UI's upload box
+        else:
+            return None
+
+        for k, v in state.items(): self.collected_data[k] = v
+        data = {
+            "thought": f"Fast-path: filled '{slot}' without LLM.",
+            "message_to_user": _FAST_MESSAGES.get(action) or _SLOT_PROMPTS[self._next_slot()],
+            "action": action,
+            "action_params": params,
+            "updated_ad_state": state,
+        }
+        self._remember(user_input, data)
+        return data
+
+    async def stream_message(self, user_input, system_context=None, attempt=0):
+        """Yields the partial message_to_user text while Gemini streams, then the final response dict."""
+        # Deterministic turns skip the model round-trip
+        if not system_context and not attempt:
+            fast = self._fast_route(user_input)
+            if fast:
+                yield fast
+                return
 
-    def process_message(self, user_input, system_context=None, retry=False):
         # Build Context
         context = f"Auth status: {'OK' if self.api_client.access_token else 'None'}"
-        if system_context: context += f" | System Msg: {system_context}"
+        context += f" | Ad state: {orjson.dumps(self.collected_data).decode()}"
+        if self.history_summary: context += f" | Earlier: {self.history_summary}"
+        # API results may be read-only mappings; render them as plain dicts
+        if system_context: context += f" | System Msg: {dict(system_context) if isinstance(system_context, Mapping) else system_context}"
         
-        msgs = [{"role": "user", "parts": [self.system_prompt]}, {"role": "model", "parts": ["OK"]}]
-        for t in self.history:
-            msgs.append({"role": "user", "parts": [t["user"]]})
-            msgs.append({"role": "model", "parts": [json.dumps(t["agent"])]})
+        msgs = [m for t in (*self._trimmed, *self.history) for m in t["msgs"]]
         msgs.append({"role": "user", "parts": [f"Ctx: {context}\nUser: {user_input}"]})
 
+        # Repeated turns (same window, state and input) replay the cached reply instead of calling Gemini.
+        # Re-asks always carry a system message, so they never hit the cache.
+        cache_key = None
+        if not system_context:
+            cache_key = hashlib.blake2b(orjson.dumps(msgs), digest_size=16).hexdigest()
+        text = _cached_response(cache_key) if cache_key else None
+
+        reask = None
         try:
-            res = self.model.generate_content(msgs)
-            
-            # Robust Text Extraction
-            text = None
-            if hasattr(res, "text"):
-                text = res.text
-            elif hasattr(res, "output_text"):
-                text = res.output_text
-            elif hasattr(res, "candidates") and res.candidates:
-                cand = res.candidates[0]
-                text = getattr(cand, "content", None) or getattr(cand, "output", None)
+            if text is None:
+                model = self.models[self._complexity(user_input, system_context)]
+                chunks, shown, closed = [], "", False
+                q = asyncio.Queue()
+                pump = asyncio.create_task(_pump_stream(model, msgs, q))
+                try:
+                    while (piece := await q.get()) is not None:
+                        if isinstance(piece, Exception): raise piece
+                        chunks.append(piece)
+                        # Once message_to_user has closed, the rest of the stream is only buffered
+                        if closed: continue
+                        partial, closed = _partial_message("".join(chunks))
+                        if partial and partial != shown:
+                            shown = partial
+                            yield partial
+                finally:
+                    # Consumer gone early (disconnect, generator closed): stop reading and free the slot
+                    pump.cancel()
+                text = "".join(chunks)
             
             if not text:
-                raise RuntimeError(f"Model returned no usable text. Raw: {repr(res)}")
+                raise RuntimeError("Model returned no usable text.")
 
-            # Clean markdown
-            if "```json" in text: text = text.split("```json")[1].split("```")[0]
-            elif "```" in text: text = text.split("```")[1].split("```")[0]
-            
-            data = json.loads(text.strip())
+            data = _parse_reply(text)
             
             # Schema Validation
-            validate(instance=data, schema=AGENT_OUTPUT_SCHEMA)
+            validate_agent_output(data)
+            if cache_key and data["action"] == "NONE": _cache_response(cache_key, text)
             
             # Merge State
             new_state = data.get("updated_ad_state", {})
-            for k, v in new_state.items(): self.collected_data[k] = v 
+            for k, v in new_state.items():
+                if k == "creative_details":
+                    # Key by key: a reply carrying only ad_text must not drop the committed music_id
+                    self.collected_data.setdefault("creative_details", {}).update(v)
+                else:
+                    self.collected_data[k] = v
             
-            self.history.append({"user": user_input, "agent": data})
-            return data
+            # Music set without an explicit validation step: start checking it now
+            mid = (new_state.get("creative_details") or {}).get("music_id")
+            if mid and data["action"] != "VALIDATE_MUSIC": self._prefetch_music(mid)
+            
+            self._remember(user_input, data)
+            yield data
 
-        except ValidationError as e:
-            if not retry:
-                return self.process_message(user_input, f"JSON Schema Error: {str(e)}. Retry with valid JSON.", retry=True)
-            return {"thought": "Fail", "message_to_user": "System Error: Output Validation Failed.", "action": "NONE"}
+        except (SchemaError, json.JSONDecodeError) as e:
+            # Re-ask with the validator error so the model can self-correct within this turn
+            if attempt < MAX_REASKS:
+                reask = str(e)
+            else:
+                yield {"thought": "Fail", "message_to_user": "System Error: Output Validation Failed.", "action": "NONE"}
         except Exception as e:
-            print("RAW MODEL ERROR:", str(e))
-            # If we have a response object but parsing failed, print it
-            if 'res' in locals():
-                print("RAW MODEL RESPONSE:", repr(res))
-            return {"thought": "Fail", "message_to_user": f"System Error: {str(e)}", "action": "NONE"}
+            logger.error("Model error: %s", e)
+            # If we have reply text but parsing failed, log it (only at DEBUG)
+            if text and logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Raw model response: %r", text)
+            yield {"thought": "Fail", "message_to_user": f"System Error: {str(e)}", "action": "NONE"}
+
+        if reask:
+            async for part in self.stream_message(user_input, f"JSON Schema Error: {reask}. Retry with valid JSON.", attempt=attempt + 1):
+                yield part
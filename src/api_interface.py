@@ -1,3 +1,4 @@
+import asyncio
 from abc import ABC, abstractmethod
 from typing import Dict
 
@@ -16,3 +17,16 @@ class TikTokAPI(ABC):
     def upload_music(self, file_name: str) -> Dict: pass
     @abstractmethod
     def ensure_token(self) -> Dict: pass
+
+    # Async variants for the UI/agent event loop. Clients stay sync on their pooled session;
+    # these hop to a worker thread so a TikTok round-trip never blocks other sessions.
+    async def a_get_auth_url(self) -> str:
+        return await asyncio.to_thread(self.get_auth_url)
+    async def a_ensure_token(self) -> Dict:
+        return await asyncio.to_thread(self.ensure_token)
+    async def a_validate_music_id(self, music_id: str) -> Dict:
+        return await asyncio.to_thread(self.validate_music_id, music_id)
+    async def a_submit_ad(self, payload: Dict) -> Dict:
+        return await asyncio.to_thread(self.submit_ad, payload)
+    async def a_upload_music(self, file_name: str) -> Dict:
+        return await asyncio.to_thread(self.upload_music, file_name)
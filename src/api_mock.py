@@ -1,11 +1,18 @@
 import secrets
+from types import MappingProxyType
 from typing import Dict
 from src.api_interface import TikTokAPI
 
+# Fixed mock responses, shared read-only instead of rebuilt per call
+_OK = MappingProxyType({"status": "success"})
+_COPYRIGHT_ERR = MappingProxyType({"status": "error", "message": "Copyright Error"})
+_NOT_FOUND = MappingProxyType({"status": "error", "message": "Not Found"})
+
 class MockTikTokAPI(TikTokAPI):
     def __init__(self):
         self.access_token = None
-        self.music_db = {"123": True, "456": False} # ID: Valid
+        self._valid_ids = frozenset({"123"})
+        self._invalid_ids = frozenset({"456"})  # copyrighted
         self.mock_failures = {"geo": False}
 
     def get_auth_url(self) -> str:
@@ -21,13 +28,12 @@ class MockTikTokAPI(TikTokAPI):
 
     def ensure_token(self) -> Dict:
         if not self.access_token: return {"status": "error", "message": "Not Connected"}
-        return {"status": "success"}
+        return {"status": "success", "refreshed": False}
 
     def validate_music_id(self, music_id: str) -> Dict:
-        if music_id.startswith("mock_up"): return {"status": "success"}
-        if music_id in self.music_db:
-            return {"status": "success"} if self.music_db[music_id] else {"status": "error", "message": "Copyright Error"}
-        return {"status": "error", "message": "Not Found"}
+        if music_id in self._valid_ids or music_id.startswith("mock_up"): return _OK
+        if music_id in self._invalid_ids: return _COPYRIGHT_ERR
+        return _NOT_FOUND
 
     def submit_ad(self, payload: Dict) -> Dict:
         if self.mock_failures["geo"]: return {"status": "error", "code": 403, "message": "Geo Restricted"}
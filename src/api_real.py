@@ -1,82 +1,140 @@
 import os
-import json
 import time
+import orjson
+import hashlib
+import tempfile
+import logging
 import secrets
+import threading
 import requests
 import urllib.parse
+from types import MappingProxyType
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from typing import Dict
+from collections import OrderedDict
 from src.api_interface import TikTokAPI
-from src.config import TIKTOK_APP_ID, TIKTOK_SECRET, TIKTOK_REDIRECT_URI, TOKEN_FILE
+from src.config import TIKTOK_APP_ID, TIKTOK_SECRET, TIKTOK_REDIRECT_URI, TOKEN_FILE, TOKEN_REFRESH_PCT, MUSIC_CACHE_TTL
+
+logger = logging.getLogger(__name__)
+
+STATE_TTL = 600  # seconds an OAuth state stays valid
+MIN_EXPIRY_BUFFER = 60  # always refresh at least this many seconds before expiry
+REQUEST_TIMEOUT = (3.05, 10)  # (connect, read) seconds for ad/create
+UPLOAD_TIMEOUT = (3.05, 60)
+UPLOAD_CHUNK = 64 * 1024
+MUSIC_CACHE_SIZE = 1024  # validated music IDs kept at most
+_JSON_HEADERS = {"Content-Type": "application/json"}
+_OK = MappingProxyType({"status": "success", "refreshed": False})  # shared read-only fast-path result
 
 class RealTikTokAPI(TikTokAPI):
     def __init__(self):
         self.access_token = None
         self.refresh_token = None
         self.expires_at = 0
+        self.issued_at = 0
+        self.expires_in = 0
+        self._valid_until = 0  # time.monotonic() deadline after which ensure_token refreshes
         self.advertiser_id = os.getenv("TIKTOK_ADVERTISER_ID")
-        self.state_file = "oauth_state.json"
+        # Pending OAuth states (state -> expiry); the callback server shares this instance in-process
+        self._states = OrderedDict()
+        self._states_lock = threading.Lock()
+        self._music_cache = OrderedDict()  # music_id -> (validated_at, result); successes only
+        self._music_lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        # One pooled keep-alive session for all TikTok calls (thread-safe for the callback + UI threads)
+        self.session = requests.Session()
+        # Only gateway-level statuses are transient; TikTok reports API errors in the JSON body
+        retry = Retry(total=2, backoff_factor=0.2, status_forcelist=[502, 503, 504])
+        # Few hosts (business-api + oauth), many concurrent requests per host
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=20, max_retries=retry))
+        # Everything but the per-flow state is fixed, so encode it once
+        self._auth_url_prefix = "https://www.tiktok.com/v2/auth/authorize/?" + urllib.parse.urlencode({
+            "client_key": TIKTOK_APP_ID,
+            "response_type": "code",
+            "scope": "ads_management,creative_management",
+            "redirect_uri": TIKTOK_REDIRECT_URI
+        })
         self.load_token()
 
     def _save_state(self, state):
-        try:
-            with open(self.state_file, "w") as f: json.dump({"state": state}, f)
-        except: pass
+        now = time.time()
+        with self._states_lock:
+            # Insertion order is expiry order, so stale states are always at the front
+            while self._states and next(iter(self._states.values())) < now:
+                self._states.popitem(last=False)
+            self._states[state] = now + STATE_TTL
 
     def verify_state(self, received_state):
         if not received_state: return False
-        try:
-            if os.path.exists(self.state_file):
-                saved = json.load(open(self.state_file)).get("state")
-                return saved == received_state
-        except: pass
-        return False
+        # One-shot: a state is consumed by its callback
+        with self._states_lock:
+            expires = self._states.pop(received_state, None)
+        return expires is not None and expires > time.time()
 
     def load_token(self):
         # NOTE: Tokens are saved in plaintext. Use encryption/keyring for production.
         if os.path.exists(TOKEN_FILE):
             try:
-                with open(TOKEN_FILE, "r") as f:
-                    data = json.load(f)
+                with open(TOKEN_FILE, "rb") as f:
+                    data = orjson.loads(f.read())
                     self.access_token = data.get("access_token")
                     self.refresh_token = data.get("refresh_token")
                     self.expires_at = data.get("expires_at", 0)
+                    # Files written before issued_at/expires_in were stored fall back to the expiry buffer
+                    self.issued_at = data.get("issued_at", self.expires_at)
+                    self.expires_in = data.get("expires_in", 0)
             except Exception as e:
-                print(f"Failed to load token: {e}")
+                logger.warning("Failed to load token: %s", e)
+        self._set_deadline()
+
+    def _set_deadline(self):
+        # Refresh after TOKEN_REFRESH_PCT of the lifetime, but never later than MIN_EXPIRY_BUFFER before expiry.
+        # Converted once to the monotonic clock so NTP jumps can't shift it and the hot path is a single compare.
+        refresh_at = min(self.issued_at + self.expires_in * TOKEN_REFRESH_PCT, self.expires_at - MIN_EXPIRY_BUFFER)
+        self._valid_until = time.monotonic() + (refresh_at - time.time()) if self.access_token else 0
 
     def save_token(self, access_token, refresh_token, scope, expires_in):
+        old_expires_at = self.expires_at
+        unchanged = access_token == self.access_token and refresh_token == self.refresh_token
         self.access_token = access_token
         self.refresh_token = refresh_token
-        self.expires_at = time.time() + expires_in
+        self.issued_at = time.time()
+        self.expires_in = expires_in
+        self.expires_at = self.issued_at + expires_in
+        self._set_deadline()
+        # Same tokens and (near) same expiry: the file on disk is already good
+        if unchanged and abs(self.expires_at - old_expires_at) < 60: return
+
+        # Write to a temp file and swap it in, so a crash mid-write never leaves a corrupt token file
+        tmp = None
         try:
-            with open(TOKEN_FILE, "w") as f:
-                json.dump({
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(TOKEN_FILE)), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(orjson.dumps({
                     "access_token": access_token,
                     "refresh_token": refresh_token,
                     "scope": scope,
-                    "expires_at": self.expires_at
-                }, f)
+                    "expires_at": self.expires_at,
+                    "issued_at": self.issued_at,
+                    "expires_in": self.expires_in
+                }))
+            os.replace(tmp, TOKEN_FILE)
         except Exception as e:
-            print(f"Failed to save token: {e}")
+            logger.warning("Failed to save token: %s", e)
+            if tmp and os.path.exists(tmp): os.remove(tmp)
 
     def get_auth_url(self) -> str:
-        base = "https://www.tiktok.com/v2/auth/authorize/"
         state = secrets.token_hex(8)
         self._save_state(state)
-        params = {
-            "client_key": TIKTOK_APP_ID,
-            "response_type": "code",
-            "scope": "ads_management,creative_management",
-            "redirect_uri": TIKTOK_REDIRECT_URI,
-            "state": state
-        }
-        return f"{base}?{urllib.parse.urlencode(params)}"
+        return f"{self._auth_url_prefix}&state={state}"
 
     def get_access_token(self, code: str) -> Dict:
         url = "https://business-api.tiktok.com/open_api/v1.3/oauth2/access_token/"
         params = {"app_id": TIKTOK_APP_ID, "secret": TIKTOK_SECRET, "auth_code": code}
         try:
-            resp = requests.post(url, json=params)
-            data = resp.json()
+            resp = self.session.post(url, data=orjson.dumps(params), headers=_JSON_HEADERS)
+            data = orjson.loads(resp.content)
             if data.get("code") == 0:
                 d = data["data"]
                 # Scope Parsing
@@ -97,7 +155,16 @@ class RealTikTokAPI(TikTokAPI):
         except Exception as e:
             return {"status": "error", "message": str(e)}
 
-    def refresh_access_token(self) -> bool:
+    def refresh_access_token(self, rejected_token=None) -> bool:
+        # Concurrent callers coalesce on one refresh RPC: late arrivals reuse the token the first one fetched.
+        # Checked under the lock; rejected_token is the token a request got a 401 with, else the deadline decides.
+        with self._refresh_lock:
+            if rejected_token is None:
+                if time.monotonic() < self._valid_until: return True
+            elif self.access_token and self.access_token != rejected_token: return True
+            return self._refresh_access_token()
+
+    def _refresh_access_token(self) -> bool:
         if not self.refresh_token: return False
         url = "https://business-api.tiktok.com/open_api/v1.3/oauth2/refresh_token/"
         params = {
@@ -107,8 +174,8 @@ class RealTikTokAPI(TikTokAPI):
             "grant_type": "refresh_token"
         }
         try:
-            resp = requests.post(url, json=params)
-            data = resp.json()
+            resp = self.session.post(url, data=orjson.dumps(params), headers=_JSON_HEADERS)
+            data = orjson.loads(resp.content)
             if data.get("code") == 0:
                 d = data["data"]
                 self.save_token(d["access_token"], d.get("refresh_token"), d.get("scope"), d.get("expires_in", 86400))
@@ -118,16 +185,32 @@ class RealTikTokAPI(TikTokAPI):
         return False
 
     def ensure_token(self) -> Dict:
-        # Buffer of 5 minutes
-        if self.access_token and time.time() < (self.expires_at - 300):
-            return {"status": "success"}
+        if time.monotonic() < self._valid_until: return _OK
         
         if self.refresh_access_token():
-            return {"status": "success"}
+            return {"status": "success", "refreshed": True}
             
         return {"status": "error", "code": 401, "message": "Session expired. Please reconnect TikTok."}
 
+    def clear_music_cache(self):
+        with self._music_lock:
+            self._music_cache.clear()
+
+    def _cache_music(self, music_id, result):
+        now = time.monotonic()
+        with self._music_lock:
+            # Kept in validation order, so expired entries are always at the front
+            while self._music_cache and now - next(iter(self._music_cache.values()))[0] >= MUSIC_CACHE_TTL:
+                self._music_cache.popitem(last=False)
+            self._music_cache[music_id] = (now, result)
+            self._music_cache.move_to_end(music_id)
+            if len(self._music_cache) > MUSIC_CACHE_SIZE: self._music_cache.popitem(last=False)
+
     def validate_music_id(self, music_id: str) -> Dict:
+        # The same ID is typically checked on VALIDATE_MUSIC and again before SUBMIT_AD
+        hit = self._music_cache.get(music_id)
+        if hit and time.monotonic() - hit[0] < MUSIC_CACHE_TTL: return hit[1]
+
         auth = self.ensure_token()
         if auth["status"] == "error": return auth
         
@@ -135,39 +218,63 @@ class RealTikTokAPI(TikTokAPI):
         headers = {"Access-Token": self.access_token}
         params = {"music_id": music_id, "advertiser_id": self.advertiser_id}
         try:
-            resp = requests.get(url, headers=headers, params=params)
-            data = resp.json()
-            if data.get("code") == 0: return {"status": "success", "data": data["data"]}
+            resp = self.session.get(url, headers=headers, params=params)
+            data = orjson.loads(resp.content)
+            if data.get("code") == 0:
+                result = {"status": "success", "data": data["data"]}
+                self._cache_music(music_id, result)
+                return result
             return {"status": "error", "message": data.get("message")}
         except Exception as e: return {"status": "error", "message": str(e)}
 
     def submit_ad(self, payload: Dict) -> Dict:
-        # Auto-Retry Logic
-        for attempt in range(2):
-            auth = self.ensure_token()
-            if auth["status"] == "error" and attempt == 0:
-                 # Force refresh attempt if not already tried by ensure_token implicitly
-                 if self.refresh_access_token(): continue
-                 return auth
-            if auth["status"] == "error": return auth
-    
-            url = "https://business-api.tiktok.com/open_api/v1.3/ad/create/"
-            headers = {"Access-Token": self.access_token}
-            payload["advertiser_id"] = self.advertiser_id
-            
+        auth = self.ensure_token()
+        if auth["status"] == "error": return auth
+
+        url = "https://business-api.tiktok.com/open_api/v1.3/ad/create/"
+        payload["advertiser_id"] = self.advertiser_id
+        # A token ensure_token just fetched won't be fixed by refreshing again
+        refreshed_once = auth["refreshed"]
+        # Serialized once with orjson; a 401 retry resends the same bytes
+        body = orjson.dumps(payload)
+
+        while True:
             try:
-                resp = requests.post(url, headers=headers, json=payload)
-                data = resp.json()
+                headers = {"Access-Token": self.access_token, "Content-Type": "application/json"}
+                resp = self.session.post(url, headers=headers, data=body, timeout=REQUEST_TIMEOUT)
+                data = orjson.loads(resp.content)
                 if data.get("code") == 0: return {"status": "success", "ad_id": data["data"]["ad_id"]}
-                
-                # If 401, refresh and retry
-                if data.get("code") == 401 and attempt == 0:
-                    if self.refresh_access_token(): continue
-                
-                return {"status": "error", "code": data.get("code"), "message": data.get("message")}
-            except Exception as e: 
-                if attempt == 1: return {"status": "error", "message": str(e)}
-        return {"status": "error", "message": "Max retries exceeded"}
+            except Exception as e: return {"status": "error", "message": str(e)}
+
+            # A 401 gets exactly one refresh + retry per submit
+            if data.get("code") == 401 and not refreshed_once:
+                refreshed_once = True
+                if self.refresh_access_token(headers["Access-Token"]): continue
+            return {"status": "error", "code": data.get("code"), "message": data.get("message")}
 
     def upload_music(self, file_name: str) -> Dict:
-        return {"status": "error", "message": "Real Upload Not Implemented in Demo"}
+        auth = self.ensure_token()
+        if auth["status"] == "error": return auth
+
+        url = "https://business-api.tiktok.com/open_api/v1.3/file/music/upload/"
+        try:
+            # The signature needs the file's MD5; hash it in chunks rather than reading it whole
+            md5 = hashlib.md5()
+            with open(file_name, "rb") as f:
+                for chunk in iter(lambda: f.read(UPLOAD_CHUNK), b""): md5.update(chunk)
+                f.seek(0)
+                name = os.path.basename(file_name)
+                resp = self.session.post(url, headers={"Access-Token": self.access_token}, data={
+                    "advertiser_id": self.advertiser_id,
+                    "upload_type": "UPLOAD_BY_FILE",
+                    "music_scene": "CREATIVE_MATERIAL",
+                    "music_signature": md5.hexdigest(),
+                    "file_name": name
+                }, files={"music_file": (name, f, "audio/mpeg")}, timeout=UPLOAD_TIMEOUT)
+            data = orjson.loads(resp.content)
+            if data.get("code") == 0:
+                # A new upload can change what an ID resolves to; drop cached validations
+                self.clear_music_cache()
+                return {"status": "success", "music_id": data["data"]["music_id"]}
+            return {"status": "error", "code": data.get("code"), "message": data.get("message")}
+        except Exception as e: return {"status": "error", "message": str(e)}
@@ -1,5 +1,4 @@
 import os
-import google.generativeai as genai
 
 # --- Configuration & Security ---
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
@@ -9,8 +8,13 @@ TIKTOK_SECRET = os.getenv("TIKTOK_SECRET")
 TIKTOK_REDIRECT_URI = os.getenv("TIKTOK_REDIRECT_URI", "http://localhost:8000/callback")
 USE_REAL_API = os.getenv("USE_REAL_TIKTOK_API", "False").lower() == "true"
 TOKEN_FILE = "tiktok_token.json"
+MUSIC_CACHE_TTL = 60  # seconds a successful music validation is reused
+# Refresh access tokens once this fraction of their lifetime has elapsed
+TOKEN_REFRESH_PCT = float(os.getenv("TOKEN_REFRESH_PCT", "0.75"))
+# Constrain Gemini decoding to AGENT_RESPONSE_SCHEMA instead of relying on post-hoc validation only
+CONSTRAINED_DECODING = os.getenv("GEMINI_CONSTRAINED_DECODING", "False").lower() == "true"
+# In-flight Gemini requests shared by all sessions
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
 
 if not GOOGLE_API_KEY:
     raise RuntimeError("CRITICAL: GOOGLE_API_KEY environment variable is not set. Please set it to run the agent.")
-else:
-    genai.configure(api_key=GOOGLE_API_KEY)
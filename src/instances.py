@@ -4,4 +4,7 @@ from src.api_real import RealTikTokAPI
 from src.agent import AdAgent
 
 api_client = RealTikTokAPI() if USE_REAL_API else MockTikTokAPI()
-agent = AdAgent(api_client)
+
+def new_agent() -> AdAgent:
+    # One agent per browser session; the TikTok client is shared
+    return AdAgent(api_client)
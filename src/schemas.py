@@ -1,17 +1,66 @@
-AGENT_OUTPUT_SCHEMA = {
-    "type": "object",
+_ACTIONS = frozenset({"NONE", "VALIDATE_MUSIC", "SUBMIT_AD", "UPLOAD_MUSIC"})
+_OBJECTIVES = frozenset({"Traffic", "Conversions"})
+_REQUIRED = ("thought", "message_to_user", "action", "updated_ad_state")
+
+class SchemaError(ValueError):
+    pass
+
+def validate_agent_output(d):
+    """Validates a parsed agent reply; raises SchemaError. This function is the output contract:
+    thought/message_to_user strings, action in _ACTIONS, optional action_params object, and an
+    updated_ad_state object whose campaign_name (>= 3 chars), objective (in _OBJECTIVES),
+    creative_details.ad_text (<= 100 chars) and music_id (string, also in action_params) are
+    checked when present."""
+    if not isinstance(d, dict): raise SchemaError("data must be object")
+    for k in _REQUIRED:
+        if k not in d: raise SchemaError(f"data must contain {k}")
+    if not isinstance(d["thought"], str): raise SchemaError("data.thought must be string")
+    if not isinstance(d["message_to_user"], str): raise SchemaError("data.message_to_user must be string")
+    # Type-check before the frozenset lookups: a list/dict value would raise TypeError (unhashable) instead
+    if not isinstance(d["action"], str) or d["action"] not in _ACTIONS: raise SchemaError(f"data.action must be one of {sorted(_ACTIONS)}")
+    if "action_params" in d:
+        if not isinstance(d["action_params"], dict): raise SchemaError("data.action_params must be object")
+        if "music_id" in d["action_params"] and not isinstance(d["action_params"]["music_id"], str):
+            raise SchemaError("data.action_params.music_id must be string")
+
+    state = d["updated_ad_state"]
+    if not isinstance(state, dict): raise SchemaError("data.updated_ad_state must be object")
+    if "campaign_name" in state and not (isinstance(state["campaign_name"], str) and len(state["campaign_name"]) >= 3):
+        raise SchemaError("data.updated_ad_state.campaign_name must be string of at least 3 characters")
+    if "objective" in state and not (isinstance(state["objective"], str) and state["objective"] in _OBJECTIVES):
+        raise SchemaError("data.updated_ad_state.objective must be one of ['Conversions', 'Traffic']")
+    if "creative_details" in state:
+        creative = state["creative_details"]
+        if not isinstance(creative, dict): raise SchemaError("data.updated_ad_state.creative_details must be object")
+        if "ad_text" in creative and not (isinstance(creative["ad_text"], str) and len(creative["ad_text"]) <= 100):
+            raise SchemaError("data.updated_ad_state.creative_details.ad_text must be string of at most 100 characters")
+        # Music IDs reach str methods (and the TikTok API) unchanged
+        if "music_id" in creative and not isinstance(creative["music_id"], str):
+            raise SchemaError("data.updated_ad_state.creative_details.music_id must be string")
+    return d
+
+# Gemini response_schema (OpenAPI subset) for provider-side constrained decoding.
+# OBJECT types need explicit properties, so nested objects list the keys the UI reads.
+AGENT_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
     "required": ["thought", "message_to_user", "action", "updated_ad_state"],
     "properties": {
-        "thought": {"type": "string"},
-        "message_to_user": {"type": "string"},
-        "action": {"type": "string", "enum": ["NONE", "VALIDATE_MUSIC", "SUBMIT_AD", "UPLOAD_MUSIC"]},
-        "action_params": {"type": "object"},
+        "thought": {"type": "STRING"},
+        "message_to_user": {"type": "STRING"},
+        "action": {"type": "STRING", "enum": ["NONE", "VALIDATE_MUSIC", "SUBMIT_AD", "UPLOAD_MUSIC"]},
+        "action_params": {
+            "type": "OBJECT",
+            "properties": {"music_id": {"type": "STRING"}}
+        },
         "updated_ad_state": {
-            "type": "object",
+            "type": "OBJECT",
             "properties": {
-                "campaign_name": {"type": "string"},
-                "objective": {"type": "string"},
-                "creative_details": {"type": "object"}
+                "campaign_name": {"type": "STRING"},
+                "objective": {"type": "STRING", "enum": ["Traffic", "Conversions"]},
+                "creative_details": {
+                    "type": "OBJECT",
+                    "properties": {"ad_text": {"type": "STRING"}, "music_id": {"type": "STRING"}}
+                }
             }
         }
     }
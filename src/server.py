@@ -1,3 +1,4 @@
+import html
 import threading
 import uvicorn
 from fastapi import FastAPI
@@ -6,26 +7,34 @@ from typing import Optional
 from src.config import USE_REAL_API
 from src.instances import api_client
 
+# Static pages built once; only the API error page is filled per request
+_NO_CODE_HTML = "<h1>Error: No code provided.</h1>"
+_BAD_STATE_HTML = "<h1>Error: Invalid State (CSRF Warning).</h1>"
+_CONNECTED_HTML = "<h1>Connected! You can close this tab and return to the Agent.</h1>"
+_ERROR_HTML = "<h1>Error: {}</h1>"
+
 # --- Callback Server ---
-app = FastAPI()
+# Callback-only server: no interactive docs or schema routes in production
+app = FastAPI(docs_url=None, redoc_url=None, openapi_url=None)
 
 @app.get("/callback")
-@app.get("/callback")
-async def callback(code: Optional[str] = None, state: Optional[str] = None):
+def callback(code: Optional[str] = None, state: Optional[str] = None):
+    # Sync handler: FastAPI runs it in its threadpool, so the blocking token exchange never stalls the event loop
     if not code:
-        return HTMLResponse("<h1>Error: No code provided.</h1>")
+        return HTMLResponse(_NO_CODE_HTML)
     
     if USE_REAL_API:
         if not api_client.verify_state(state):
-             return HTMLResponse("<h1>Error: Invalid State (CSRF Warning).</h1>")
+             return HTMLResponse(_BAD_STATE_HTML)
 
     res = api_client.get_access_token(code)
     if res["status"] == "success":
-        return HTMLResponse("<h1>Connected! You can close this tab and return to the Agent.</h1>")
-    return HTMLResponse(f"<h1>Error: {res.get('message')}</h1>")
+        return HTMLResponse(_CONNECTED_HTML)
+    return HTMLResponse(_ERROR_HTML.format(html.escape(str(res.get('message')))))
 
 def run_server():
-    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="error")
+    # loop="auto" picks uvloop when installed (not available on Windows)
+    uvicorn.run(app, host="0.0.0.0", port=8000, log_level="error", loop="auto", http="httptools", access_log=False)
 
 def start_server_thread():
     # Start Server Thread
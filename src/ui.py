@@ -1,99 +1,181 @@
-import gradio as gr
-from src.instances import agent, api_client
+import os
+import asyncio
+from src.instances import new_agent, api_client
 from src.config import USE_REAL_API
 
-def chat_interface(user_input, history):
-    if not user_input: return history
-    
-    resp = agent.process_message(user_input)
-    msg = resp["message_to_user"]
-    action = resp.get("action")
+# Follow-up advice for TikTok submit errors, by status code
+_ADVICE_MAP = {
+    401: "Session expired or invalid token. Please reconnect via the Connect button (will refresh tokens) or reauthorize.",
+    403: "Permission or geo restriction. Check TikTok developer console and your campaign targeting.",
+}
+_SERVER_ADVICE = "Server error at TikTok. Will retry shortly. If repeated, try again later."
+# Music uploads only ever come from the gr.File component, never from chat text
+_AUDIO_EXTS = frozenset({".mp3", ".wav", ".m4a", ".aac", ".ogg"})
+# Objectives that cannot be submitted without music
+_REQUIRES_MUSIC = frozenset({"Conversions"})
+
+def format_api_error(code, msg_api, advice) -> str:
+    return f"API Error {code}: {msg_api}\n\n{advice}"
+
+# Chat events are async, so many can share the loop; Gemini load is capped separately by GEMINI_MAX_CONCURRENCY
+CHAT_CONCURRENCY = 16
+QUEUE_MAX_SIZE = 64  # pending events beyond this are rejected instead of piling up
+LAUNCH_MAX_THREADS = 64  # worker threads for sync handlers and to_thread'd TikTok calls
+
+async def _stream_turn(agent, reply, text, system_context=None):
+    # Streams one agent turn into the reply message: yields None per update, then the response dict
+    async for part in agent.stream_message(text, system_context):
+        if isinstance(part, dict):
+            yield part
+        else:
+            reply["content"] = part
+            yield None
+
+async def _handle_validate(resp, agent, msg, music_file=None):
+    mid = resp.get("action_params", {}).get("music_id")
+    if mid:
+        r = await agent.validate_music(mid)
+        if r["status"] == "error":
+            agent.reject_music(mid)
+            return msg, ("Validation Error: " + r["message"], r)
+        prompt = agent.accept_music(mid)
+        if prompt: msg += f"\n{prompt}"
+    return msg, None
+
+async def _handle_upload(resp, agent, msg, music_file=None):
+    # The path is Gradio's copy of the attached file; a name typed in chat (or chosen by the LLM) is never opened
+    if not music_file:
+        return msg + "\n(System: Attach an audio file in the Music file box, then say 'upload'.)", None
+    if os.path.splitext(music_file)[1].lower() not in _AUDIO_EXTS:
+        return msg + f"\n(System: Only audio files can be uploaded: {', '.join(sorted(_AUDIO_EXTS))}.)", None
+    r = await api_client.a_upload_music(music_file)
+    if r["status"] == "success":
+        mid = r["music_id"]
+        agent.clear_music_checks()
+        prompt = agent.accept_music(mid)
+        msg += f"\n(System: Uploaded ID {mid})" + (f"\n{prompt}" if prompt else "")
+    else:
+        msg += f"\n(System: Upload failed: {r['message']})"
+    return msg, None
+
+def _report(agent, msg, note):
+    # Reported straight to the user, but also noted in the agent's history so the next turn knows the outcome
+    agent.record_event(note)
+    return f"{msg}\n\n{note}", None
+
+async def _handle_submit(resp, agent, msg, music_file=None):
     state = agent.collected_data # Use accumulated state
+    # Read the ad state once; the payload below reuses these same objects
+    campaign_name, objective = state.get("campaign_name"), state.get("objective")
+    creative = state.get("creative_details") or {}
+    mid = creative.get("music_id")
+    # No music is an absent key, never "music_id": null in the payload
+    if "music_id" in creative and mid is None: creative = {k: v for k, v in creative.items() if k != "music_id"}
+
+    # Local shape check first: no point validating remotely what can't be submitted
+    if not campaign_name or not objective:
+        return _report(agent, msg, "System Error: Payload incomplete (Missing Name/Objective).")
+
+    # Strict Pre-Check
+    errors = []
+    if objective in _REQUIRES_MUSIC and not mid:
+        errors.append(f"{objective} require Music.")
     
-    if action == "VALIDATE_MUSIC":
-        mid = resp.get("action_params", {}).get("music_id")
-        if mid:
-            r = api_client.validate_music_id(mid)
-            if r["status"] == "error":
-                resp = agent.process_message("Validation Error: " + r["message"], system_context=r)
-                msg = resp["message_to_user"]
-
-    elif action == "UPLOAD_MUSIC":
-        r = api_client.upload_music("test.mp3")
-        if r["status"] == "success":
-            mid = r["music_id"]
-            if "creative_details" not in agent.collected_data: agent.collected_data["creative_details"] = {}
-            agent.collected_data["creative_details"]["music_id"] = mid
-            msg += f"\n(System: Uploaded ID {mid})"
-    
-    elif action == "SUBMIT_AD":
-        # Strict Pre-Check
-        errors = []
-        if state.get("objective") == "Conversions" and not state.get("creative_details", {}).get("music_id"):
-            errors.append("Conversions require Music.")
+    # Remote checks are independent: run them concurrently (latency = slowest, not the sum)
+    checks = {}
+    if mid: checks["Music Invalid"] = agent.validate_music(mid)
+    # The mock has no real OAuth flow; the real client refreshes here, overlapping the music check
+    if USE_REAL_API: checks["Auth"] = api_client.a_ensure_token()
+    results = await asyncio.gather(*checks.values(), return_exceptions=True)
+    for label, r in zip(checks, results):
+        if isinstance(r, Exception): errors.append(f"{label}: {r}")
+        elif r["status"] == "error": errors.append(f"{label}: {r['message']}")
         
-        # Strict Music Check
-        mid = state.get("creative_details", {}).get("music_id")
-        if mid:
-            mr = api_client.validate_music_id(mid)
-            if mr["status"] == "error": errors.append(f"Music Invalid: {mr['message']}")
-            
-        if errors:
-            resp = agent.process_message("Submit Blocked: " + ";".join(errors))
+    # Known failures are reported directly; an LLM turn would only rephrase them
+    if errors:
+        return _report(agent, msg, f"Submit Blocked: {'; '.join(errors)}")
+
+    payload = {"campaign": {"name": campaign_name, "objective": objective}, "creative": creative}
+    r = await api_client.a_submit_ad(payload)
+    if r["status"] == "error":
+        code = r.get("code")
+        msg_api = r.get("message", "")
+        advice = _ADVICE_MAP.get(code) or (_SERVER_ADVICE if code and 500 <= code < 600 else None)
+        if advice: return _report(agent, msg, format_api_error(code, msg_api, advice))
+        # Unknown codes go back to the agent (strong model, no fast path/cache), which can relate them to the ad state
+        return msg, (f"API Error {code}: {msg_api}. Advice: Check payload and music. {msg_api}", r)
+    return _report(agent, msg, f"SUCCESS! Ad ID: {r.get('ad_id')}")
+
+# Agent action -> handler(resp, agent, msg, music_file) returning (msg, follow_up); follow_up is
+# (text, system_context) for an agent turn explaining a failed action, or None
+_HANDLERS = {
+    "VALIDATE_MUSIC": _handle_validate,
+    "UPLOAD_MUSIC": _handle_upload,
+    "SUBMIT_AD": _handle_submit,
+}
+
+async def chat_interface(user_input, history, agent, music_file=None):
+    if not user_input:
+        yield history, "", agent
+        return
+    # Agent construction may build Gemini models; keep it off the event loop
+    agent = agent or await asyncio.to_thread(new_agent)
+    
+    # Stream the agent's reply into the chat as it is generated
+    # Messages format: only the assistant message object changes while the turn streams
+    reply = {"role": "assistant", "content": ""}
+    history += [{"role": "user", "content": user_input}, reply]
+    async for resp in _stream_turn(agent, reply, user_input):
+        if resp is None: yield history, "", agent
+    msg = resp["message_to_user"]
+
+    handler = _HANDLERS.get(resp.get("action"))
+    if handler:
+        # Show the full reply before any TikTok call so the user sees progress while it runs
+        reply["content"] = msg
+        yield history, "", agent
+        msg, follow_up = await handler(resp, agent, msg, music_file)
+
+        # Failed actions hand back to the agent; its explanation streams into the same bubble
+        if follow_up:
+            async for resp in _stream_turn(agent, reply, *follow_up):
+                if resp is None: yield history, "", agent
             msg = resp["message_to_user"]
-        else:
-            # Payload
-            payload = {
-                "campaign": {"name": state.get("campaign_name"), "objective": state.get("objective")},
-                "creative": state.get("creative_details", {})
-            }
-            
-            if not payload["campaign"]["name"] or not payload["campaign"]["objective"]:
-                 resp = agent.process_message("System Error: Payload incomplete (Missing Name/Objective).")
-                 msg = resp["message_to_user"]
-            else:
-                r = api_client.submit_ad(payload)
-                if r["status"] == "error":
-                    code = r.get("code")
-                    msg_api = r.get("message", "")
-                    
-                    if code == 401:
-                        advice = "Session expired or invalid token. Please reconnect via the Connect button (will refresh tokens) or reauthorize."
-                    elif code == 403:
-                        advice = "Permission or geo restriction. Check TikTok developer console and your campaign targeting."
-                    elif code and 500 <= code < 600:
-                        advice = "Server error at TikTok. Will retry shortly. If repeated, try again later."
-                    else:
-                        advice = "Check payload and music. " + msg_api
-                    
-                    resp = agent.process_message(f"API Error {code}: {msg_api}. Advice: {advice}")
-                    msg = resp["message_to_user"]
-                else:
-                    msg += f"\n\nSUCCESS! Ad ID: {r.get('ad_id')}"
-
-    history.append((user_input, msg))
-    return history
-
-def connect():
-    return f"Please authorize here (Callback will auto-handle): {api_client.get_auth_url()}"
-
-with gr.Blocks(title="TikTok Agent") as demo:
-    gr.Markdown("# Production TikTok Agent")
-    gr.Markdown("Auto-Callback running on localhost:8000")
+
+    reply["content"] = msg
+    yield history, "", agent
+
+async def connect():
+    return f"Please authorize here (Callback will auto-handle): {await api_client.a_get_auth_url()}"
+
+async def set_geo(x):
+    api_client.mock_failures["geo"] = bool(x)
+    return ""
+
+def build_demo():
+    # Gradio is heavy; import and build the UI only when the app is actually launched
+    import gradio as gr
+
+    with gr.Blocks(title="TikTok Agent") as demo:
+        gr.Markdown("# Production TikTok Agent")
+        gr.Markdown("Auto-Callback running on localhost:8000")
     
-    with gr.Row():
-        auth_url_box = gr.Textbox(label="Auth URL")
-        connect_btn = gr.Button("Connect")
-        connect_btn.click(connect, inputs=None, outputs=auth_url_box)
+        with gr.Row():
+            auth_url_box = gr.Textbox(label="Auth URL")
+            connect_btn = gr.Button("Connect")
+            connect_btn.click(connect, inputs=None, outputs=auth_url_box)
         
-        if not USE_REAL_API:
-             geo_cb = gr.Checkbox(label="Simulate Geo Fail", value=False)
-             # Explicit wiring
-             def set_geo(x):
-                 api_client.mock_failures["geo"] = bool(x)
-                 return ""
-             geo_cb.change(set_geo, inputs=[geo_cb], outputs=[auth_url_box])
+            if not USE_REAL_API:
+                 geo_cb = gr.Checkbox(label="Simulate Geo Fail", value=False)
+                 # Explicit wiring
+                 geo_cb.change(set_geo, inputs=[geo_cb], outputs=[auth_url_box])
             
-    chatbot = gr.Chatbot(height=500)
-    txt = gr.Textbox()
-    txt.submit(chat_interface, [txt, chatbot], [chatbot]).then(lambda: "", None, txt)
+        chatbot = gr.Chatbot(height=500, type="messages")
+        agent_state = gr.State(None)
+        txt = gr.Textbox()
+        music_file = gr.File(label="Music file", file_types=["audio"], type="filepath")
+        # One event per message: the handler also clears the textbox.
+        # trigger_mode="once" drops repeat submits while a turn is still running; empty input is still guarded server-side.
+        txt.submit(chat_interface, [txt, chatbot, agent_state, music_file], [chatbot, txt, agent_state], concurrency_limit="default", trigger_mode="once")
+    demo.queue(default_concurrency_limit=CHAT_CONCURRENCY, max_size=QUEUE_MAX_SIZE)
+    return demo
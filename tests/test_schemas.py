@@ -0,0 +1,37 @@
+import unittest
+from src.schemas import SchemaError, validate_agent_output
+
+def reply(**overrides):
+    d = {"thought": "t", "message_to_user": "m", "action": "NONE", "updated_ad_state": {}}
+    d.update(overrides)
+    return d
+
+class ValidateAgentOutputTest(unittest.TestCase):
+    def test_valid_reply_passes(self):
+        d = reply(updated_ad_state={"campaign_name": "Summer", "objective": "Traffic", "creative_details": {"ad_text": "Hi"}})
+        self.assertIs(validate_agent_output(d), d)
+
+    def test_non_string_action_is_schema_error(self):
+        for bad in (["NONE"], {"a": 1}, 1, None):
+            with self.subTest(action=bad), self.assertRaises(SchemaError):
+                validate_agent_output(reply(action=bad))
+
+    def test_non_string_objective_is_schema_error(self):
+        for bad in (["Traffic"], {"a": 1}, 1, None):
+            with self.subTest(objective=bad), self.assertRaises(SchemaError):
+                validate_agent_output(reply(updated_ad_state={"objective": bad}))
+
+    def test_non_string_music_id_is_schema_error(self):
+        for bad in (123, ["123"], None):
+            with self.subTest(music_id=bad):
+                with self.assertRaises(SchemaError):
+                    validate_agent_output(reply(action="VALIDATE_MUSIC", action_params={"music_id": bad}))
+                with self.assertRaises(SchemaError):
+                    validate_agent_output(reply(updated_ad_state={"creative_details": {"music_id": bad}}))
+
+    def test_unknown_action_is_schema_error(self):
+        with self.assertRaises(SchemaError):
+            validate_agent_output(reply(action="DELETE_AD"))
+
+if __name__ == "__main__":
+    unittest.main()